@@ -1,9 +1,10 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
 from datetime import datetime
 import io
-#import yfinance as yf
+import yfinance as yf
 
 # Define market indices
 MARKET_INDICES = {
@@ -15,115 +16,204 @@ MARKET_INDICES = {
     'Shanghai Composite': '000001.SS'
 }
 
-def fetch_index_data(start_date, end_date):
+@st.cache_data(ttl=3600)
+def fetch_all_indices_range(global_start, global_end):
     """
-    Fetch data for all market indices for the given date range
+    Fetch data for all market indices in one batched download covering the
+    date range of every uploaded stock, so switching stocks never refetches
     """
     index_data = {}
+    try:
+        data = yf.download(list(MARKET_INDICES.values()), start=global_start, end=global_end,
+                           group_by='ticker', threads=True, progress=False)
+    except Exception as e:
+        st.warning(f"Could not fetch market indices data: {str(e)}")
+        return index_data
+    
     for index_name, ticker in MARKET_INDICES.items():
         try:
-            data = yf.download(ticker, start=start_date, end=end_date)
-            if not data.empty:
+            ticker_data = data[ticker][['Close']].dropna()
+            if not ticker_data.empty:
                 # Rename columns to match our format
-                data = data.reset_index()
-                data = data.rename(columns={'Date': 'Date', 'Close': 'Price'})
-                index_data[index_name] = data
+                ticker_data = ticker_data.reset_index()
+                ticker_data = ticker_data.rename(columns={'Date': 'Date', 'Close': 'Price'})
+                index_data[index_name] = ticker_data
         except Exception as e:
             st.warning(f"Could not fetch data for {index_name}: {str(e)}")
     return index_data
 
-def check_rows(df):
+def slice_index_data(index_data, start_date, end_date):
+    """
+    Restrict the fetched market indices to the date range of a single stock
+    """
+    sliced = {}
+    for index_name, index_df in index_data.items():
+        index_df = index_df.loc[index_df['Date'].between(start_date, end_date)]
+        if not index_df.empty:
+            sliced[index_name] = index_df
+    return sliced
+
+def parse_dates(dates):
     """
-    Validates and cleans the dataframe by iterating through rows and checking:
+    Convert a Date column to datetimes with the cheapest parser that fits:
+    native datetimes pass through, numbers (whole columns or single cells) are
+    read as Excel serial dates and strings are parsed as ISO 8601, then with a
+    single inferred format, falling back to per-element inference.
+    Timezone-aware values are converted to UTC and returned tz-naive
+    """
+    if isinstance(dates.dtype, pd.DatetimeTZDtype):
+        return dates.dt.tz_convert(None)
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    if pd.api.types.is_bool_dtype(dates):
+        # True/False cells are not dates, even though bool counts as numeric
+        return pd.Series(pd.NaT, index=dates.index, dtype='datetime64[ns]')
+    if pd.api.types.is_numeric_dtype(dates):
+        return pd.to_datetime(dates, unit='D', origin='1899-12-30', errors='coerce')
+    
+    parsed = pd.to_datetime(dates, format='ISO8601', errors='coerce', utc=True)
+    failed = parsed.isna() & dates.notna()
+    
+    # Mixed columns can hold Excel serial numbers next to date cells or strings;
+    # the ISO pass leaves those as NaT, so only the failures need checking
+    serial = pd.Series(False, index=dates.index)
+    if failed.any():
+        serial[failed] = dates[failed].map(
+            lambda value: pd.api.types.is_number(value) and not isinstance(value, (bool, np.bool_))
+        ).to_numpy(dtype=bool)
+    
+    retry = failed & ~serial
+    if retry.any():
+        # Most non-ISO columns still use one format, which pandas can infer once
+        parsed[retry] = pd.to_datetime(dates[retry], errors='coerce', utc=True)
+        retry = parsed.isna() & retry
+    if retry.any():
+        parsed[retry] = pd.to_datetime(dates[retry], format='mixed', errors='coerce', utc=True)
+    if serial.any():
+        parsed[serial] = pd.to_datetime(dates[serial].astype('float64'), unit='D',
+                                        origin='1899-12-30', errors='coerce', utc=True)
+    
+    # Strings are parsed as UTC so mixed offsets share one dtype; drop the timezone once
+    return parsed.dt.tz_convert(None)
+
+def check_rows(sheets):
+    """
+    Validates and cleans all sheets in a single column-wise pass, checking for:
     1. Null values
     2. Date format
     3. Price values (must be numeric and positive)
-    Returns the cleaned dataframe and validation messages
+    Returns the cleaned dataframes and validation messages, keyed by sheet name
     """
-    original_rows = len(df)
-    messages = []
-    valid_rows = []
-    invalid_rows = []
+    dfs = {}
+    validation_messages = {}
+    if not sheets:
+        return dfs, validation_messages
     
-    # Iterate through each row
-    for index, row in df.iterrows():
-        is_valid = True
-        row_messages = []
-        
-        # Check for null values
-        if row.isnull().any():
-            is_valid = False
-            row_messages.append("Contains null values")
-        
-        # Validate date
-        try:
-            date_val = pd.to_datetime(row['Date'])
-        except Exception:
-            is_valid = False
-            row_messages.append("Invalid date format")
-        
-        # Validate price
-        try:
-            price_val = pd.to_numeric(row['Price'], errors='coerce')
-            if pd.isna(price_val) or price_val <= 0:
-                is_valid = False
-                row_messages.append("Invalid price value")
-        except Exception:
-            is_valid = False
-            row_messages.append("Price is not numeric")
-        
-        # Store row based on validation
-        if is_valid:
-            valid_rows.append(row)
-        else:
-            invalid_rows.append({
-                'index': index,
-                'messages': row_messages
-            })
+    # Coerce each sheet's columns on their own, so one sheet's cell types can't
+    # change how another is parsed; unparseable entries become NaT/NaN
+    typed = {
+        sheet: pd.DataFrame({
+            'Date': parse_dates(sheet_df['Date']),
+            'Price': pd.to_numeric(sheet_df['Price'], errors='coerce'),
+            'date_null': sheet_df['Date'].isnull(),
+            'price_null': sheet_df['Price'].isnull()
+        })
+        for sheet, sheet_df in sheets.items()
+    }
     
-    # Create new dataframe with only valid rows
-    if valid_rows:
-        cleaned_df = pd.DataFrame(valid_rows)
-        # Ensure date column is datetime
-        cleaned_df['Date'] = pd.to_datetime(cleaned_df['Date'])
-        # Ensure price column is numeric
-        cleaned_df['Price'] = pd.to_numeric(cleaned_df['Price'])
-    else:
-        return None, ["No valid rows found in the data"]
+    # Stack the typed sheets into one frame, keeping each row's sheet and original index
+    df = pd.concat(typed, names=['sheet']).reset_index(level=0)
+    
+    # Validate every sheet at once
+    null_mask = df['date_null'] | df['price_null']
+    dates = df['Date']
+    prices = df['Price']
+    invalid_date = dates.isna() & ~df['date_null']
+    invalid_price = prices.isna() | (prices <= 0)
+    valid = ~null_mask & dates.notna() & prices.notna() & (prices > 0)
+    invalid = ~valid
     
-    # Generate validation messages
-    if invalid_rows:
-        messages.append(f"Removed {len(invalid_rows)} invalid rows:")
-        for invalid in invalid_rows:
-            messages.append(f"Row {invalid['index'] + 1}: {', '.join(invalid['messages'])}")
+    # Keep only the typed Date/Price columns so st.dataframe takes Arrow's fast path
+    cleaned = df.loc[valid, ['sheet', 'Date', 'Price']]
+    cleaned = cleaned.astype({'Date': 'datetime64[ns]', 'Price': 'float64'})
     
-    # Add summary message
-    removed_rows = original_rows - len(cleaned_df)
-    if removed_rows > 0:
-        messages.append(f"Total rows removed: {removed_rows}")
+    # Describe every invalid row, grouped by the sheet it came from
+    reasons = (
+        pd.Series(np.where(null_mask, 'Contains null values, ', ''), index=df.index)
+        + np.where(invalid_date, 'Invalid date format, ', '')
+        + np.where(invalid_price, 'Invalid price value, ', '')
+    )[invalid].str[:-2]
+    reasons_by_sheet = dict(tuple(reasons.groupby(df.loc[invalid, 'sheet'], sort=False)))
     
-    return cleaned_df, messages
+    # Split back into one dataframe per sheet; sheets with no valid rows are dropped
+    for sheet, cleaned_df in cleaned.groupby('sheet', sort=False):
+        dfs[sheet] = cleaned_df.drop(columns='sheet')
+        
+        # Generate validation messages
+        messages = []
+        sheet_reasons = reasons_by_sheet.get(sheet)
+        if sheet_reasons is not None:
+            messages.append(f"Removed {len(sheet_reasons)} invalid rows:")
+            for index, reason in sheet_reasons.items():
+                messages.append(f"Row {index + 1}: {reason}")
+            
+            # Add summary message
+            messages.append(f"Total rows removed: {len(sheet_reasons)}")
+        validation_messages[sheet] = messages
+    
+    return dfs, validation_messages
 
-def prepare_candlestick_data(df):
+@st.cache_data(show_spinner=False)
+def load_workbook(file_bytes):
     """
-    Prepare OHLC data for candlestick chart by resampling daily data
+    Read every sheet of the uploaded Excel file and validate it with check_rows.
+    Cached on the raw file bytes so widget changes don't reparse the workbook.
+    Returns the cleaned dataframes and validation messages, keyed by sheet name
     """
-    # Set date as index for resampling
-    df = df.set_index('Date')
+    # Parse all sheets in a single pass over the workbook
+    all_sheets = pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, engine='calamine')
     
-    # Resample to daily OHLC
-    ohlc = df['Price'].resample('D').agg({
-        'Open': 'first',
-        'High': 'max',
-        'Low': 'min',
-        'Close': 'last'
-    }).dropna()
+    # Ensure each sheet has the required columns
+    sheets = {
+        sheet: df for sheet, df in all_sheets.items()
+        if 'Date' in df.columns and 'Price' in df.columns
+    }
     
-    # Rename 'Close' to 'Price' to match the original data
-    ohlc = ohlc.rename(columns={'Close': 'Price'})
+    # Validate and clean every sheet at once
+    return check_rows(sheets)
+
+def prepare_candlestick_data(df):
+    """
+    Prepare OHLC data for candlestick chart by aggregating prices per day
+    """
+    # Group on the calendar day directly; only days with data produce a bar
+    ohlc = df.groupby(df['Date'].dt.floor('D'))['Price'].agg(['first', 'max', 'min', 'last'])
+    
+    # Name the columns to match the original data ('last' is the closing Price)
+    ohlc.columns = ['Open', 'High', 'Low', 'Price']
     
     return ohlc
 
+def downsample_for_display(df, target=5000):
+    """
+    Reduce a price series for plotting: intraday data is cut to one point per
+    day (the last price of each day), then histories longer than `target`
+    points keep only the lowest and highest price of evenly sized buckets
+    """
+    days = df['Date'].dt.floor('D')
+    last_of_day = ~days.duplicated(keep='last')
+    if not last_of_day.all():
+        df = df.loc[last_of_day]
+    if len(df) <= target:
+        return df
+    
+    # Keep each bucket's extremes so spikes survive the cut
+    bucket_size = -(-len(df) // (target // 2))
+    buckets = np.arange(len(df)) // bucket_size
+    grouped = pd.Series(df['Price'].to_numpy()).groupby(buckets)
+    keep = np.union1d(grouped.idxmin().to_numpy(), grouped.idxmax().to_numpy())
+    return df.iloc[keep]
+
 def create_line_chart(df, selected_stock, index_data=None):
     """
     Create a line chart visualization with optional market indices
@@ -131,9 +221,9 @@ def create_line_chart(df, selected_stock, index_data=None):
     fig = go.Figure()
     
     # Add main stock data
-    fig.add_trace(go.Scatter(
-        x=df['Date'],
-        y=df['Price'],
+    fig.add_trace(go.Scattergl(
+        x=df['Date'].to_numpy(dtype='datetime64[ms]'),
+        y=df['Price'].to_numpy(),
         mode='lines',
         name=selected_stock,
         line=dict(width=2)
@@ -142,9 +232,9 @@ def create_line_chart(df, selected_stock, index_data=None):
     # Add market indices if available
     if index_data:
         for index_name, index_df in index_data.items():
-            fig.add_trace(go.Scatter(
-                x=index_df['Date'],
-                y=index_df['Price'],
+            fig.add_trace(go.Scattergl(
+                x=index_df['Date'].to_numpy(dtype='datetime64[ms]'),
+                y=index_df['Price'].to_numpy(),
                 mode='lines',
                 name=index_name,
                 line=dict(width=1, dash='dash'),
@@ -167,16 +257,19 @@ def create_candlestick_chart(df, selected_stock, index_data=None):
     Create a candlestick chart visualization with optional market indices
     """
     ohlc_data = prepare_candlestick_data(df)
+    dates = ohlc_data.index.to_numpy(dtype='datetime64[ms]')
     
     fig = go.Figure()
     
     # Add main stock candlestick
     fig.add_trace(go.Candlestick(
-        x=ohlc_data.index,
-        open=ohlc_data['Open'],
-        high=ohlc_data['High'],
-        low=ohlc_data['Low'],
-        close=ohlc_data['Price'],
+        x=dates,
+        open=ohlc_data['Open'].to_numpy(),
+        high=ohlc_data['High'].to_numpy(),
+        low=ohlc_data['Low'].to_numpy(),
+        close=ohlc_data['Price'].to_numpy(),
+        increasing_line_color='green',
+        decreasing_line_color='red',
         name=selected_stock
     ))
     
@@ -184,24 +277,14 @@ def create_candlestick_chart(df, selected_stock, index_data=None):
     if index_data:
         for index_name, index_df in index_data.items():
             fig.add_trace(go.Scatter(
-                x=index_df['Date'],
-                y=index_df['Price'],
+                x=index_df['Date'].to_numpy(dtype='datetime64[ms]'),
+                y=index_df['Price'].to_numpy(),
                 mode='lines',
                 name=index_name,
                 line=dict(width=1, dash='dash'),
                 opacity=0.7
             ))
     
-    # Add volume bars at the bottom
-    fig.add_trace(go.Bar(
-        x=ohlc_data.index,
-        y=ohlc_data['Price'] - ohlc_data['Open'],
-        name='Volume',
-        marker_color=['red' if price < open else 'green' 
-                    for price, open in zip(ohlc_data['Price'], ohlc_data['Open'])],
-        opacity=0.3
-    ))
-    
     fig.update_layout(
         title=f"{selected_stock} Price History with Market Indices",
         xaxis_title="Date",
@@ -217,6 +300,100 @@ def create_candlestick_chart(df, selected_stock, index_data=None):
     
     return fig
 
+@st.cache_resource(show_spinner=False)
+def build_chart(df, selected_stock, chart_type, index_data=None):
+    """
+    Build the selected chart type.
+    Cached on the chart inputs so unrelated reruns skip figure construction;
+    the figure is shared rather than copied, so callers must not modify it
+    """
+    if index_data:
+        index_data = {
+            index_name: downsample_for_display(index_df)
+            for index_name, index_df in index_data.items()
+        }
+    
+    if chart_type == "Line Chart":
+        fig = create_line_chart(downsample_for_display(df), selected_stock, index_data)
+    else:
+        fig = create_candlestick_chart(df, selected_stock, index_data)
+    
+    return fig
+
+@st.fragment
+def render_chart(dfs):
+    """
+    Render the chart controls, metrics, chart and raw data for the selected stock.
+    Runs as a fragment so changing a control only reruns this function,
+    not the workbook ingestion above it
+    """
+    # Fragment reruns happen outside the main script's error handling
+    try:
+        # Chart controls (st.sidebar can't be written to from inside a fragment)
+        st.subheader("Chart Controls")
+        control_col1, control_col2, control_col3 = st.columns(3)
+        
+        # Stock selection
+        with control_col1:
+            selected_stock = st.selectbox(
+                "Select Stock",
+                options=list(dfs.keys())
+            )
+        
+        # Chart type selection
+        with control_col2:
+            chart_type = st.radio(
+                "Select Chart Type",
+                options=["Line Chart", "Candlestick Chart"],
+                index=0,
+                horizontal=True
+            )
+        
+        # Market indices toggle
+        with control_col3:
+            show_indices = st.checkbox("Show Market Indices", value=True)
+        
+        # Get the selected dataframe
+        df = dfs[selected_stock]
+        
+        # Fetch market indices data if enabled
+        index_data = None
+        if show_indices:
+            with st.spinner("Fetching market indices data..."):
+                global_start = min(stock_df['Date'].min() for stock_df in dfs.values())
+                global_end = max(stock_df['Date'].max() for stock_df in dfs.values())
+                all_index_data = fetch_all_indices_range(global_start, global_end)
+            index_data = slice_index_data(all_index_data, df['Date'].min(), df['Date'].max())
+        
+        # Read the first and last prices once as plain floats
+        prices = df['Price'].to_numpy()
+        first_price, current_price = float(prices[0]), float(prices[-1])
+        price_change = current_price - first_price
+        percent_change = price_change / first_price * 100.0
+        
+        # Create two columns for metrics
+        col1, col2, col3 = st.columns(3)
+        
+        with col1:
+            st.metric("Current Price", f"${current_price:.2f}")
+        
+        with col2:
+            st.metric("Total Change", f"${price_change:.2f}")
+        
+        with col3:
+            st.metric("Percentage Change", f"{percent_change:.2f}%")
+        
+        # Create the selected chart type
+        fig = build_chart(df, selected_stock, chart_type, index_data)
+        st.plotly_chart(fig, use_container_width=True)
+        
+        # Display raw data
+        st.subheader("Raw Data")
+        st.dataframe(df)
+    
+    except Exception as e:
+        st.error(f"An error occurred: {str(e)}")
+
 # Set page configuration
 st.set_page_config(
     page_title="Stock Price Dashboard",
@@ -236,28 +413,8 @@ uploaded_file = st.file_uploader("Upload your Excel file", type=['xlsx'])
 
 if uploaded_file is not None:
     try:
-        # Read all sheets from the Excel file
-        excel_file = pd.ExcelFile(uploaded_file)
-        sheet_names = excel_file.sheet_names
-        
-        # Create a dictionary to store dataframes
-        dfs = {}
-        validation_messages = {}
-        
-        # Read each sheet
-        for sheet in sheet_names:
-            df = pd.read_excel(uploaded_file, sheet_name=sheet)
-            # Ensure the dataframe has the required columns
-            if 'Date' in df.columns and 'Price' in df.columns:
-                # Validate and clean the data
-                cleaned_df, messages = check_rows(df)
-                if cleaned_df is not None:
-                    dfs[sheet] = cleaned_df
-                    validation_messages[sheet] = messages
-                #else:
-                #    st.error(f"Sheet '{sheet}' has invalid data: {'; '.join(messages)}")
-            #else:
-            #    st.warning(f"Sheet '{sheet}' does not contain required 'Date' and 'Price' columns")
+        # Read and validate all sheets (cached on the file contents)
+        dfs, validation_messages = load_workbook(uploaded_file.getvalue())
         
         if dfs:
             # Display validation messages
@@ -267,62 +424,8 @@ if uploaded_file is not None:
                         for msg in messages:
                             st.info(msg)'''
             
-            # Sidebar controls
-            st.sidebar.header("Chart Controls")
-            
-            # Stock selection
-            selected_stock = st.sidebar.selectbox(
-                "Select Stock",
-                options=list(dfs.keys())
-            )
-            
-            # Chart type selection
-            chart_type = st.sidebar.radio(
-                "Select Chart Type",
-                options=["Line Chart", "Candlestick Chart"],
-                index=0
-            )
-            
-            # Market indices toggle
-            show_indices = st.sidebar.checkbox("Show Market Indices", value=True)
-            
-            # Get the selected dataframe
-            df = dfs[selected_stock]
-            
-            # Fetch market indices data if enabled
-            index_data = None
-            if show_indices:
-                with st.spinner("Fetching market indices data..."):
-                    start_date = df['Date'].min()
-                    end_date = df['Date'].max()
-                    index_data = fetch_index_data(start_date, end_date)
-            
-            # Create two columns for metrics
-            col1, col2, col3 = st.columns(3)
-            
-            with col1:
-                current_price = df['Price'].iloc[-1]
-                st.metric("Current Price", f"${current_price:.2f}")
-            
-            with col2:
-                price_change = df['Price'].iloc[-1] - df['Price'].iloc[0]
-                st.metric("Total Change", f"${price_change:.2f}")
-            
-            with col3:
-                percent_change = (price_change / df['Price'].iloc[0]) * 100
-                st.metric("Percentage Change", f"{percent_change:.2f}%")
-            
-            # Create the selected chart type
-            if chart_type == "Line Chart":
-                fig = create_line_chart(df, selected_stock, index_data)
-            else:
-                fig = create_candlestick_chart(df, selected_stock, index_data)
-            
-            st.plotly_chart(fig, use_container_width=True)
-            
-            # Display raw data
-            st.subheader("Raw Data")
-            st.dataframe(df)
+            # Render the controls, metrics and chart
+            render_chart(dfs)
             
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")